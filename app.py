@@ -1,33 +1,51 @@
+try:
+    # gevent must patch the stdlib before anything else imports socket/threading.
+    from gevent import monkey
+except ImportError:  # fall back to the threaded Werkzeug server
+    monkey = None
+else:
+    monkey.patch_all()
+
 from threading import Thread, Event
 import signal
 
-from utils import load_config, is_host_reachable
-from network import start_udp_listener, start_fake_data, request_shutdown
+from utils import load_config
+from network import start_udp_listener, request_shutdown
 from dash_app import build_dash_app
 
 
 if __name__ == "__main__":
     cfg = load_config()
 
-    simulink_ok = is_host_reachable(cfg["udp"]["send_host"])
-    target_fn = start_udp_listener if simulink_ok else start_fake_data
-
     stop_event = Event()
+    http_server = None
 
     def _handle_signal(signum, frame):
         request_shutdown()
         stop_event.set()
+        if http_server is not None:
+            http_server.stop(timeout=1)
 
     signal.signal(signal.SIGINT, _handle_signal)
     signal.signal(signal.SIGTERM, _handle_signal)
 
-    listener_t = Thread(target=target_fn, args=(cfg, stop_event))
+    listener_t = Thread(target=start_udp_listener, args=(cfg, stop_event))
     listener_t.start()
 
     dash_app = build_dash_app(cfg)
-    host_addr = "192.168.7.15" if simulink_ok else "127.0.0.1"
+    dash_cfg = cfg.get("dashboard", {})
+    host_addr = dash_cfg.get("host", "127.0.0.1")
+    port = dash_cfg.get("port", 8050)
     try:
-        dash_app.run(host=host_addr, port=8050, debug=False, use_reloader=False, threaded=True)
+        if monkey is not None:
+            # One greenlet per SSE client instead of one OS thread each.
+            from gevent.pywsgi import WSGIServer
+
+            http_server = WSGIServer((host_addr, port), dash_app.server, log=None)
+            print(f"Serving dashboard on http://{host_addr}:{port} (gevent)")
+            http_server.serve_forever()
+        else:
+            dash_app.run(host=host_addr, port=port, debug=False, use_reloader=False, threaded=True)
     finally:
         _handle_signal(None, None)
         listener_t.join()
@@ -12,6 +12,12 @@ COLOR_CYCLE = [
 CONFIG_FILE = "config.yaml"
 CONTROL_FMT = "<4f"
 UPDATE_MS = 10
+# samples are coalesced into one SSE frame for at most this long
+SSE_BATCH_MS = 20
+# faster streams are decimated to roughly this many points per second per trace
+PLOT_RATE_HZ = 200
+# plotted values are rounded to this many decimals before they are sent
+PLOT_DECIMALS = 4
 N_WINDOW_SEC = 10
 SAMPLE_RATE_HZ = 100
 
@@ -1,22 +1,54 @@
 import json
 import string
-from typing import Dict, Any
+import threading
+import time
+import zlib
+from itertools import islice, repeat
+from queue import Empty
+from typing import Dict, Any, List
+
+try:
+    import orjson
+except ImportError:  # fall back to the stdlib encoder
+    orjson = None
 
 import dash
 from dash import dcc, html, Input, Output, State
 from dash_extensions import EventSource
 import plotly.graph_objs as go
-from flask import Response
-
-from constants import COLOR_CYCLE, N_WINDOW_SEC, SAMPLE_RATE_HZ
-from state import event_q, MAX_CLIENTS, _active_clients, _client_lock
-from network import send_control_packet
+from flask import Response, request
+
+from constants import (
+    COLOR_CYCLE,
+    N_WINDOW_SEC,
+    PLOT_DECIMALS,
+    PLOT_RATE_HZ,
+    SAMPLE_RATE_HZ,
+    SSE_BATCH_MS,
+)
+from state import SAMPLE_FIELDS, broadcast, next_sample, subscribe, unsubscribe
+from network import queue_control_packet
+
+_EMIT_INTERVAL = SSE_BATCH_MS / 1000.0
+_MAX_BATCH = 50
+# plotted sample fields; statusword and avg_dt are only sent for the latest
+_SERIES_KEYS = SAMPLE_FIELDS[:7]
+_SCALAR_KEYS = _SERIES_KEYS[:-2]
+# only the first IMU channels are plotted
+_PLOTTED_IMUS = 3
+# idle streams send an SSE comment this often so proxies keep them open
+_HEARTBEAT_SEC = 15.0
 
 
 def make_line_with_marker(name: str, color: str) -> list[go.Scattergl]:
-    """Return a line trace and a marker-only trace for the legend."""
+    """Return a line trace and a marker-only trace for the legend.
+
+    The arguments are constants, so plotly's per-attribute validation is
+    skipped.
+    """
     clean_name = name.replace("_", " ")
     line = go.Scattergl(
+        _validate=False,
         x=[],
         y=[],
         mode="lines",
@@ -26,6 +58,7 @@ def make_line_with_marker(name: str, color: str) -> list[go.Scattergl]:
         showlegend=False,
     )
     marker = go.Scattergl(
+        _validate=False,
         x=[None],
         y=[None],
         mode="markers",
@@ -37,6 +70,235 @@ def make_line_with_marker(name: str, color: str) -> list[go.Scattergl]:
     return [line, marker]
 
 
+def _quantize(values) -> list[float]:
+    """Round *values* to ``PLOT_DECIMALS`` places.
+
+    The packet carries float32 values, which widen to doubles whose shortest
+    repr runs to 17 digits; rounding keeps the JSON frames several times
+    smaller without a visible change on the plots.
+    """
+    return list(map(round, values, repeat(PLOT_DECIMALS)))
+
+
+def plot_stride(avg_dt: float) -> int:
+    """Return how many samples to advance per plotted point so a stream
+    with sample interval *avg_dt* is thinned to about ``PLOT_RATE_HZ``."""
+    if avg_dt <= 0:
+        return 1
+    return max(1, round(1.0 / (avg_dt * PLOT_RATE_HZ)))
+
+
+def merge_samples(batch: List[tuple], count: int, step: int = 1, offset: int = 0) -> Dict[str, Any]:
+    """Merge the first *count* samples of *batch* into one payload whose
+    series fields are lists.
+
+    Only every *step*-th sample from index *offset* on is kept; the caller
+    carries the offset across batches so the stride stays even over the
+    whole stream. ``avg_dt`` is scaled by *step* so the browser sizes its
+    trace buffers for the thinned stream. ``press`` and ``imu`` are sent
+    channel-major (one list per plotted trace) so the browser can hand them
+    to Plotly.extendTraces without transposing.
+    """
+    picked = islice(batch, offset, count, step)
+    # zip transposes the sample tuples in C; the trailing columns are never built
+    merged: Dict[str, Any] = dict(zip(_SERIES_KEYS, zip(*picked)))
+    for key in _SCALAR_KEYS:
+        merged[key] = _quantize(merged[key])
+    merged["press"] = list(map(_quantize, zip(*merged["press"])))
+    merged["imu"] = list(map(_quantize, islice(zip(*merged["imu"]), _PLOTTED_IMUS)))
+    merged["statusword"], avg_dt = batch[count - 1][-2:]
+    merged["avg_dt"] = avg_dt * step
+    return merged
+
+
+def encode_frame(payload: Dict[str, Any]) -> bytes:
+    """Serialize *payload* as one SSE ``data:`` frame."""
+    if orjson is not None:
+        return b"data:" + orjson.dumps(payload) + b"\n\n"
+    return f"data:{json.dumps(payload)}\n\n".encode()
+
+
+# Clientside SSE handler; depends only on constants, so it is built once at import.
+_GRAPH_UPDATE_JS = string.Template(
+    r"""
+    (function(){
+        // Constants are baked in once when the callback is registered.
+        var GRAPH_IDS = ['torque', 'ankle', 'gait', 'press', 'imu'];
+        var DEFAULT_WINDOW = ${default_window};
+        var DEFAULT_DT = 1.0 / ${sample_rate};
+
+        var colorReady = '#FFD280';
+        var colorFault = '#FF9E9E';
+        var colorReached = '#8FE38F';
+        var colorDefault = '#cccccc';
+
+        function textColorFor(bg){
+            if(!bg || bg.charAt(0) !== '#') return '#000000';
+            var r = parseInt(bg.slice(1,3), 16);
+            var g = parseInt(bg.slice(3,5), 16);
+            var b = parseInt(bg.slice(5,7), 16);
+            var brightness = (r*299 + g*587 + b*114)/1000;
+            return brightness > 150 ? '#000000' : '#ffffff';
+        }
+
+        // The button can only take these four colours; build each style once.
+        var STYLES = {};
+        [colorReady, colorFault, colorReached, colorDefault].forEach(function(c){
+            STYLES[c] = {backgroundColor: c, color: textColorFor(c)};
+        });
+        var lastColor = null;
+
+        // dcc.Graph puts its id on a wrapper; Plotly owns the inner div.
+        function plotDiv(id){
+            var outer = document.getElementById(id);
+            return outer ? outer.querySelector('.js-plotly-plot') : null;
+        }
+
+        function setRange(gd, range){
+            try {
+                Plotly.relayout(gd, {'xaxis.autorange': false, 'xaxis.range': range});
+            } catch(e) { /* ignore before initial render */ }
+        }
+
+        // The frame layout is fixed by merge_samples, so it is checked
+        // on the first message only.
+        var validated = false;
+        function validate(p){
+            return Array.isArray(p.t) && Array.isArray(p.torque) &&
+                Array.isArray(p.press) && p.press.length === 8 &&
+                Array.isArray(p.imu) && p.imu.length === 3;
+        }
+
+        // Extend traces in place instead of routing the points through
+        // Dash's extendData prop and store. The x-range is written into
+        // the layout first so the redraw extendTraces already does picks
+        // it up, instead of a second redraw from Plotly.relayout.
+        function extend(id, update, indices, maxPoints, range){
+            var gd = plotDiv(id);
+            if(!gd || !gd.layout) return;
+            var xaxis = gd.layout.xaxis || (gd.layout.xaxis = {});
+            xaxis.autorange = false;
+            xaxis.range = range;
+            Plotly.extendTraces(gd, update, indices, maxPoints);
+        }
+
+        function windowChanged(){
+            var ctx = window.dash_clientside.callback_context;
+            return !!(ctx && ctx.triggered && ctx.triggered.some(function(t){
+                return t.prop_id === 'window-sec.data';
+            }));
+        }
+
+        return function(msg, window_sec){
+            var no_update = window.dash_clientside.no_update;
+            // A window change re-fires with the last message still set;
+            // only the range moves then, the points were already added.
+            if(!msg || windowChanged()){
+                if(typeof window_sec === 'number'){
+                    GRAPH_IDS.forEach(function(id){
+                        var gd = plotDiv(id);
+                        if(gd && gd.data && gd.data.length && gd.data[0].x && gd.data[0].x.length){
+                            var xData = gd.data[0].x;
+                            var latest = xData[xData.length - 1];
+                            if(typeof latest !== 'number') latest = Number(latest);
+                            setRange(gd, [latest - window_sec, latest]);
+                        }
+                    });
+                }
+                return no_update;
+            }
+
+            var json_str = (typeof msg === 'string') ? msg : (msg && msg.data);
+            if(!json_str){ return no_update; }
+
+            var payload;
+            try {
+                payload = JSON.parse(json_str);
+            } catch(e){
+                console.error('failed to parse SSE payload', e);
+                return no_update;
+            }
+
+            if(!validated){
+                if(!validate(payload)){
+                    console.error('unexpected SSE payload layout', payload);
+                    return no_update;
+                }
+                validated = true;
+            }
+
+            var t = payload.t;
+            var press = payload.press;
+            var imu = payload.imu;
+            var status = payload.statusword;
+
+            var winSec = (typeof window_sec === 'number') ? window_sec : DEFAULT_WINDOW;
+            var dt = payload.avg_dt > 0 ? payload.avg_dt : DEFAULT_DT;
+            var maxPoints = Math.round(winSec / dt);
+
+            var latestT = t[t.length - 1];
+            var xrange = [latestT - winSec, latestT];
+
+            // press and imu arrive channel-major: one array per trace
+            extend('torque', {x:[t, t], y:[payload.torque, payload.demand_torque]}, [0,2], maxPoints, xrange);
+            extend('ankle', {x:[t], y:[payload.ankle]}, [0], maxPoints, xrange);
+            extend('gait', {x:[t], y:[payload.gait]}, [0], maxPoints, xrange);
+            extend('press', {x:Array(8).fill(t), y:press}, [0,2,4,6,8,10,12,14], maxPoints, xrange);
+            extend('imu', {x:Array(3).fill(t), y:imu}, [0,2,4], maxPoints, xrange);
+
+            var color = colorDefault;
+            if(status != null){
+                if(status & 0x0008){
+                    color = colorFault;
+                } else if((status & 0x0002) && (status & 0x0400)){
+                    color = colorReached;
+                } else if(status & 0x0001){
+                    color = colorReady;
+                }
+            }
+            // statusword rarely changes; skip the style update when it didn't
+            if(color === lastColor) return no_update;
+            lastColor = color;
+            return STYLES[color];
+        };
+    })()
+    """
+).substitute(sample_rate=SAMPLE_RATE_HZ, default_window=N_WINDOW_SEC)
+
+
+def _broadcast_frames() -> None:
+    """Batch published samples into SSE frames and fan them out.
+
+    Runs forever in one background thread so every frame is merged and
+    encoded once, however many clients are connected.
+    """
+    # reused for every frame; only the first ``count`` slots are live
+    batch: List[tuple] = [()] * _MAX_BATCH
+    # index of the next sample to plot, relative to the start of the batch
+    offset = 0
+    while True:
+        try:
+            batch[0] = next_sample(timeout=_HEARTBEAT_SEC)
+        except Empty:
+            continue
+        count = 1
+        deadline = time.monotonic() + _EMIT_INTERVAL
+        while count < _MAX_BATCH:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch[count] = next_sample(timeout=remaining)
+            except Empty:
+                break
+            count += 1
+        # one stride for the whole stream, from its smoothed sample interval
+        step = plot_stride(batch[count - 1][-1])
+        if offset < count:
+            broadcast(encode_frame(merge_samples(batch, count, step, offset)))
+        offset = (offset - count) % step
+
+
 def build_dash_app(cfg: Dict[str, Any]) -> dash.Dash:
     """Create and configure the Dash application."""
     meta = [
@@ -63,8 +325,6 @@ def build_dash_app(cfg: Dict[str, Any]) -> dash.Dash:
             dcc.Store(id="k-state", data=0),
             dcc.Store(id="window-sec", data=N_WINDOW_SEC),
             html.Div(id="signal-sent", style={"display": "none"}),
-            dcc.Interval(id="zero-interval", interval=100, n_intervals=0),
-            dcc.Interval(id="tab-interval", interval=1000, n_intervals=0),
             html.Div(EventSource(id="es", url="/events"), style={"display": "none"}),
             dcc.Store(id="tab-index", data=0),
             html.Div(
@@ -276,7 +536,7 @@ def build_dash_app(cfg: Dict[str, Any]) -> dash.Dash:
             html.Div(
                 id="tab-dots",
                 style={"display": "flex", "justifyContent": "center", "alignItems": "center", "marginTop": "0px", "marginBottom": "0px"},
-                children=[html.Span(className="tab-dot", id="dot-0"), html.Span(className="tab-dot", id="dot-1")],
+                children=[html.Span(className="tab-dot active", id="dot-0"), html.Span(className="tab-dot", id="dot-1")],
             ),
             html.Div(
                 className="controls-dock",
@@ -296,19 +556,6 @@ def build_dash_app(cfg: Dict[str, Any]) -> dash.Dash:
         ],
     )
 
-    app.clientside_callback(
-        """
-        function(n) {
-            var active = document.getElementById('zero-btn').matches(':active');
-            return [active ? 1 : 0, active ? 'on' : ''];
-        }
-        """,
-        Output("zero-state", "data"),
-        Output("zero-btn", "className"),
-        Input("zero-interval", "n_intervals"),
-        prevent_initial_call=False,
-    )
-
     app.clientside_callback(
         """
         function(n, state){
@@ -371,216 +618,104 @@ def build_dash_app(cfg: Dict[str, Any]) -> dash.Dash:
                 zero_state, motor_state, assist_state, k_state
             )
         )
-        send_control_packet(cfg, zero_state, motor_state, assist_state, k_state)
+        queue_control_packet(cfg, zero_state, motor_state, assist_state, k_state)
         return ""
 
-    @app.callback(
+    app.clientside_callback(
+        """
+        function(n2, n10) {
+            var triggered = window.dash_clientside.callback_context.triggered;
+            if (!triggered || !triggered.length) return window.dash_clientside.no_update;
+            return triggered[0].prop_id === 'window-2-btn.n_clicks' ? 0.4 : 2;
+        }
+        """,
         Output("window-sec", "data"),
         Input("window-2-btn", "n_clicks"),
         Input("window-10-btn", "n_clicks"),
-        State("window-sec", "data"),
         prevent_initial_call=True,
     )
-    def update_window(n2, n10, current):
-        ctx = dash.callback_context
-        if not ctx.triggered:
-            return current
-        btn = ctx.triggered[0]["prop_id"].split(".")[0]
-        if btn == "window-2-btn":
-            return 0.4
-        if btn == "window-10-btn":
-            return 2
-        return current
-
-    graph_update_js = string.Template(
-        r"""
-        function(msg, window_sec){
-            if(!msg){
-                if(typeof window_sec === 'number'){
-                    ['torque','ankle','gait','press','imu'].forEach(function(id){
-                        var gd = document.getElementById(id);
-                        if(gd && gd.data && gd.data.length && gd.data[0].x && gd.data[0].x.length){
-                            var xData = gd.data[0].x;
-                            var latest = xData[xData.length - 1];
-                            if(typeof latest !== 'number') latest = Number(latest);
-                            Plotly.relayout(gd, {
-                                'xaxis.autorange': false,
-                                'xaxis.range': [latest - window_sec, latest]
-                            });
-                        }
-                    });
-                }
-                return [null, null, null, null, null, null];
-            }
-
-            var json_str = (typeof msg === 'string') ? msg : (msg && msg.data);
-            if(!json_str){ return [null, null, null, null, null, null]; }
-
-            var payload;
-            try {
-                payload = JSON.parse(json_str);
-            } catch(e){
-                console.error('failed to parse SSE payload', e);
-                return [null, null, null, null, null, null];
-            }
-
-            var t = payload.t;
-            var ankle = payload.ankle;
-            var torque = payload.torque;
-            var demand = payload.demand_torque;
-            var gait = payload.gait;
-            var press = payload.press;
-            var imu = payload.imu;
-            var status = payload.statusword;
-            var avg_dt = payload.avg_dt;
-
-            if(!Array.isArray(t)) t = [t];
-            if(!Array.isArray(ankle)) ankle = [ankle];
-            if(!Array.isArray(torque)) torque = [torque];
-            if(!Array.isArray(demand)) demand = [demand];
-            if(!Array.isArray(gait)) gait = [gait];
-            if(press && typeof press[0] === 'number') press = [press];
-            if(imu && typeof imu[0] === 'number') imu = [imu];
-
-            var pressT = Array.from({length:8}, () => []);
-            for(var i=0;i<press.length;i++){
-                for(var j=0;j<8;j++){
-                    pressT[j].push(press[i][j]);
-                }
-            }
-
-            var imuT = Array.from({length:3}, () => []);
-            for(var i=0;i<imu.length;i++){
-                for(var j=0;j<3;j++){
-                    imuT[j].push(imu[i][j]);
-                }
-            }
-
-            var torque_payload = {x:[t, t], y:[torque, demand]};
-            var ankle_payload = {x:[t], y:[ankle]};
-            var gait_payload = {x:[t], y:[gait]};
-            var press_payload = {x:Array(8).fill(t), y:pressT};
-            var imu_payload = {x:Array(3).fill(t), y:imuT};
-
-            var colorReady = '#FFD280';
-            var colorFault = '#FF9E9E';
-            var colorReached = '#8FE38F';
-            var colorDefault = '#cccccc';
-
-            function textColorFor(bg){
-                if(!bg || bg.charAt(0) !== '#') return '#000000';
-                var r = parseInt(bg.slice(1,3), 16);
-                var g = parseInt(bg.slice(3,5), 16);
-                var b = parseInt(bg.slice(5,7), 16);
-                var brightness = (r*299 + g*587 + b*114)/1000;
-                return brightness > 150 ? '#000000' : '#ffffff';
-            }
-
-            var color = colorDefault;
-            if(status != null){
-                if(status & 0x0008){
-                    color = colorFault;
-                } else if((status & 0x0002) && (status & 0x0400)){
-                    color = colorReached;
-                } else if(status & 0x0001){
-                    color = colorReady;
-                }
-            }
-            var btn_style = {backgroundColor: color, color: textColorFor(color)};
-
-            var winSec = (typeof window_sec === 'number') ? window_sec : ${default_window};
-            var dt = (typeof avg_dt === 'number') ? avg_dt : 1.0/${sample_rate};
-            var maxPoints = Math.round(winSec / dt);
-
-            var latestT = t[t.length - 1];
-            if(typeof latestT !== 'number') latestT = Number(latestT);
-            var xrange = [latestT - winSec, latestT];
-
-            ['torque', 'ankle', 'gait', 'press', 'imu'].forEach(function(id) {
-                var gd = document.getElementById(id);
-                if(gd) {
-                    try {
-                        Plotly.relayout(gd, {
-                            'xaxis.autorange': false,
-                            'xaxis.range': xrange
-                        });
-                    } catch(e) { /* ignore before initial render */ }
-                }
-            });
-            return [
-                [torque_payload, [0,2], maxPoints],
-                [ankle_payload, [0], maxPoints],
-                [gait_payload, [0], maxPoints],
-                [press_payload, [0,2,4,6,8,10,12,14], maxPoints],
-                [imu_payload, [0,2,4], maxPoints],
-                btn_style
-            ];
-        }
-        """
-    ).substitute(sample_rate=SAMPLE_RATE_HZ, default_window=N_WINDOW_SEC)
 
     app.clientside_callback(
-        graph_update_js,
-        Output("torque", "extendData"),
-        Output("ankle", "extendData"),
-        Output("gait", "extendData"),
-        Output("press", "extendData"),
-        Output("imu", "extendData"),
+        _GRAPH_UPDATE_JS,
         Output("motor-btn", "style"),
         Input("es", "message"),
         Input("window-sec", "data"),
         prevent_initial_call=True,
     )
 
+    threading.Thread(target=_broadcast_frames, name="sse-broadcaster", daemon=True).start()
+
     @app.server.route("/events")
     def sse_stream():  # type: ignore
-        global _active_clients
-        with _client_lock:
-            if _active_clients >= MAX_CLIENTS:
-                return Response("Too many clients", status=503)
-            _active_clients += 1
+        sub = subscribe()
+        if sub is None:
+            return Response("Too many clients", status=503)
+
+        headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "Vary": "Accept-Encoding"}
+        # a quality of 0 ("gzip;q=0") is an explicit refusal
+        gzip = request.accept_encodings["gzip"] > 0
+        if gzip:
+            headers["Content-Encoding"] = "gzip"
 
         def generate():
+            # One gzip stream per client; the sync flush pushes every frame out
+            # at once while the shared window still compresses the repeated keys.
+            deflate = zlib.compressobj(1, zlib.DEFLATED, 31) if gzip else None
             try:
-                global _active_clients
                 while True:
-                    sample = event_q.get()
-                    yield f"data:{json.dumps(sample)}\n\n"
+                    try:
+                        frame = sub.get(timeout=_HEARTBEAT_SEC)
+                    except Empty:
+                        frame = b":ping\n\n"
+                    if deflate is not None:
+                        frame = deflate.compress(frame) + deflate.flush(zlib.Z_SYNC_FLUSH)
+                    yield frame
             finally:
-                with _client_lock:
-                    _active_clients -= 1
+                unsubscribe(sub)
 
-        return Response(generate(), mimetype="text/event-stream")
+        return Response(generate(), mimetype="text/event-stream", headers=headers)
 
+    # Runs once on page load and wires document-level listeners, so nothing
+    # is polled: the zero button is held-to-zero and the tab dots follow the
+    # swipe position.
     app.clientside_callback(
-        '''
-        function(n_intervals) {
-            var swipe = document.querySelector('.swipe-container');
-            if (!swipe) return window.dash_clientside.no_update;
-            if (!swipe._dotScrollHandlerAttached) {
-                swipe.addEventListener('scroll', function() {
-                    var idx = Math.round(swipe.scrollLeft / swipe.clientWidth);
-                    var dots = [document.getElementById('dot-0'), document.getElementById('dot-1')];
-                    for (var i = 0; i < dots.length; ++i) {
-                        if (dots[i]) {
-                            dots[i].className = 'tab-dot' + (i === idx ? ' active' : '');
-                        }
-                    }
-                });
-                swipe._dotScrollHandlerAttached = true;
+        """
+        function(_) {
+            var cs = window.dash_clientside;
+            if (window._afoListenersAttached) return cs.no_update;
+            window._afoListenersAttached = true;
+
+            var zeroHeld = false;
+            function setZero(held) {
+                if (held === zeroHeld) return;
+                zeroHeld = held;
+                cs.set_props('zero-state', {data: held ? 1 : 0});
+                cs.set_props('zero-btn', {className: held ? 'on' : ''});
             }
-            var idx = Math.round(swipe.scrollLeft / swipe.clientWidth);
-            var dots = [document.getElementById('dot-0'), document.getElementById('dot-1')];
-            for (var i = 0; i < dots.length; ++i) {
-                if (dots[i]) {
-                    dots[i].className = 'tab-dot' + (i === idx ? ' active' : '');
+            document.addEventListener('pointerdown', function(e) {
+                if (e.target.closest && e.target.closest('#zero-btn')) setZero(true);
+            });
+            ['pointerup', 'pointercancel'].forEach(function(type) {
+                document.addEventListener(type, function() { setZero(false); });
+            });
+
+            // scroll does not bubble, so listen in the capture phase
+            document.addEventListener('scroll', function(e) {
+                var swipe = e.target;
+                if (!swipe.classList || !swipe.classList.contains('swipe-container')) return;
+                var idx = Math.round(swipe.scrollLeft / swipe.clientWidth);
+                var dots = [document.getElementById('dot-0'), document.getElementById('dot-1')];
+                for (var i = 0; i < dots.length; ++i) {
+                    if (dots[i]) {
+                        dots[i].className = 'tab-dot' + (i === idx ? ' active' : '');
+                    }
                 }
-            }
-            return window.dash_clientside.no_update;
+            }, true);
+            return cs.no_update;
         }
-        ''',
-        Output('tab-index', 'data'),
-        Input('zero-interval', 'n_intervals'),
+        """,
+        Output("tab-index", "data"),
+        Input("tab-dots", "id"),
         prevent_initial_call=False,
     )
 
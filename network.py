@@ -1,174 +1,445 @@
+import ctypes
+import errno
+import os
 import struct
 import socket
+import sys
 import time
 import math
+import operator
+import select
 import threading
-from typing import Dict, Any
-from queue import Full
+from typing import Dict, Any, Iterator
 
 from constants import CONTROL_FMT, SAMPLE_RATE_HZ, UPDATE_MS
-from state import event_q
-from utils import decode_packet
+from state import publish
 
 # minimum interval between control packets in seconds
 _MIN_CTRL_INTERVAL = UPDATE_MS / 1000.0
-_last_ctrl_ts = 0.0
+_CONTROL = struct.Struct(CONTROL_FMT)
+# packed in place for every send; only the control-sender thread sends
+_ctrl_buf = bytearray(_CONTROL.size)
+# shared by every control packet; created by the sender thread on first send
+_ctrl_sock: socket.socket | None = None
+# latest values handed over by queue_control_packet; each call overwrites
+# the slot and the sender thread transmits it on its next tick
+_ctrl_latest: tuple | None = None
+_ctrl_ready = threading.Event()
+_ctrl_thread: threading.Thread | None = None
+_ctrl_thread_lock = threading.Lock()
+
+# Linux socket option that stamps every datagram with the socket's
+# cumulative kernel drop count; the socket module does not export it
+_SO_RXQ_OVFL = 40
+_DROP_COUNT = struct.Struct("=I")
+# native struct cmsghdr header (len, level, type) and where its data starts
+_CMSG_HEADER = struct.Struct("@Nii")
+_CMSG_DATA = socket.CMSG_LEN(0) if hasattr(socket, "CMSG_LEN") else _CMSG_HEADER.size
+# report new kernel drops at most this often (seconds)
+_DROP_REPORT_SEC = 5.0
+# most datagrams read per select() wake-up before checking for shutdown
+_DRAIN_MAX = 64
+# smoothing factor of the sample-interval EMA (~256-sample time constant)
+_DT_EMA_ALPHA = 1.0 / 256
 
 # global stop event for graceful shutdown
 _stop_event = threading.Event()
 
+# packet signals the dashboard samples are built from
+_PRESSURE_SIGNALS = tuple(f"pressure_{i}" for i in range(1, 9))
+_IMU_SIGNALS = tuple(f"imu_{i}" for i in range(1, 13))
+_SAMPLE_SIGNALS = (
+    "time",
+    "ankle_angle",
+    "actual_torque",
+    "demand_torque",
+    "gait_percentage",
+    "statusword",
+) + _PRESSURE_SIGNALS + _IMU_SIGNALS
+
+
+class _IOVec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(_IOVec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _MsgHdr), ("msg_len", ctypes.c_uint)]
+
+
+class _DatagramReader:
+    """Read one datagram per call into ``buf`` with ``recv_into``.
+
+    With *ancbufsize* set, ``recvmsg_into`` is used instead and ``dropped``
+    follows the kernel's SO_RXQ_OVFL drop counter.
+    """
+
+    count = 1
+
+    def __init__(self, sock: socket.socket, slot: int, ancbufsize: int = 0) -> None:
+        self.slot = slot
+        self.buf = bytearray(slot)
+        self.lengths = [0]
+        self.dropped = 0
+        self._sock = sock
+        self._ancbufsize = ancbufsize
+
+    def read(self) -> int:
+        """Return how many datagrams were read (0 when none are queued)."""
+        try:
+            if self._ancbufsize:
+                nbytes, ancdata, _, _ = self._sock.recvmsg_into((self.buf,), self._ancbufsize)
+                for level, kind, cdata in ancdata:
+                    if level == socket.SOL_SOCKET and kind == _SO_RXQ_OVFL:
+                        self.dropped = _DROP_COUNT.unpack(cdata)[0]
+            else:
+                nbytes = self._sock.recv_into(self.buf)
+        except BlockingIOError:
+            return 0
+        self.lengths[0] = nbytes
+        return 1
+
+
+class _BatchReader:
+    """Read up to *count* datagrams per syscall with Linux ``recvmmsg(2)``.
+
+    Datagram ``i`` lands at ``buf[i * slot:]`` and its size in
+    ``lengths[i]``. Same interface as :class:`_DatagramReader`; raises
+    ``OSError``/``AttributeError`` where libc has no ``recvmmsg``.
+    """
+
+    def __init__(self, sock: socket.socket, slot: int, count: int, ancbufsize: int = 0) -> None:
+        recvmmsg = ctypes.CDLL(None, use_errno=True).recvmmsg
+        recvmmsg.argtypes = [
+            ctypes.c_int,
+            ctypes.POINTER(_MMsgHdr),
+            ctypes.c_uint,
+            ctypes.c_int,
+            ctypes.c_void_p,
+        ]
+        recvmmsg.restype = ctypes.c_int
+        self._recvmmsg = recvmmsg
+        self._fd = sock.fileno()
+        self.count = count
+        self.slot = slot
+        self.buf = bytearray(slot * count)
+        self.lengths = [0] * count
+        self.dropped = 0
+        self._ancbufsize = ancbufsize
+        self._control = bytearray(max(ancbufsize, 1) * count)
+        # from_buffer pins both bytearrays so the addresses below stay valid
+        self._pins = (
+            ctypes.c_char.from_buffer(self.buf),
+            ctypes.c_char.from_buffer(self._control),
+        )
+        data_at, control_at = map(ctypes.addressof, self._pins)
+        self._iovs = (_IOVec * count)()
+        self._msgs = (_MMsgHdr * count)()
+        for i in range(count):
+            iov = self._iovs[i]
+            iov.iov_base = data_at + i * slot
+            iov.iov_len = slot
+            hdr = self._msgs[i].msg_hdr
+            hdr.msg_iov = ctypes.pointer(iov)
+            hdr.msg_iovlen = 1
+            if ancbufsize:
+                hdr.msg_control = control_at + i * ancbufsize
+                hdr.msg_controllen = ancbufsize
+
+    def read(self) -> int:
+        """Return how many datagrams were read (0 when none are queued)."""
+        n = self._recvmmsg(self._fd, self._msgs, self.count, socket.MSG_DONTWAIT, None)
+        if n < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return 0
+            raise OSError(err, os.strerror(err))
+        msgs = self._msgs
+        lengths = self.lengths
+        for i in range(n):
+            lengths[i] = msgs[i].msg_len
+        if self._ancbufsize:
+            for i in range(n):
+                hdr = msgs[i].msg_hdr
+                if hdr.msg_controllen:
+                    # the counter is cumulative, so the last stamp wins
+                    offset = i * self._ancbufsize
+                    _, level, kind = _CMSG_HEADER.unpack_from(self._control, offset)
+                    if level == socket.SOL_SOCKET and kind == _SO_RXQ_OVFL:
+                        self.dropped = _DROP_COUNT.unpack_from(self._control, offset + _CMSG_DATA)[0]
+                hdr.msg_controllen = self._ancbufsize
+        return n
+
 
 def request_shutdown() -> None:
     """Signal the network loops to exit cleanly."""
     _stop_event.set()
 
 
-def send_control_packet(
+def _tune_listener_thread(cfg: Dict[str, Any]) -> None:
+    """Pin the calling thread to ``udp.cpu`` and renice it by ``udp.nice``.
+
+    Both are Linux-only and best effort: a missing setting, an unsupported
+    platform or a lack of privileges leaves the thread as it was. Skipped
+    when gevent has patched threading, since the listener is then a greenlet
+    on the web server's OS thread.
+    """
+    monkey = sys.modules.get("gevent.monkey")
+    if monkey is not None and monkey.is_module_patched("threading"):
+        return
+    cpu = cfg["udp"].get("cpu")
+    if cpu is not None and hasattr(os, "sched_setaffinity"):
+        cpus = sorted(os.sched_getaffinity(0))
+        try:
+            # pid 0 is the calling thread, not the whole process, on Linux
+            os.sched_setaffinity(0, {cpus[cpu]})
+        except (IndexError, OSError) as exc:
+            print(f"Could not pin UDP listener to CPU {cpu}: {exc}")
+    nice = cfg["udp"].get("nice", 0)
+    if nice and sys.platform.startswith("linux"):
+        try:
+            os.setpriority(os.PRIO_PROCESS, 0, nice)
+        except OSError as exc:
+            print(f"Could not renice UDP listener to {nice}: {exc}")
+
+
+def _send_control(cfg: Dict[str, Any], zero: float, motor: float, assist: float, k_val: float) -> None:
+    """Send a 4-float packet containing the four control signals."""
+    global _ctrl_sock
+    if _ctrl_sock is None:
+        _ctrl_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    _CONTROL.pack_into(_ctrl_buf, 0, zero, motor, assist, k_val)
+    try:
+        _ctrl_sock.sendto(_ctrl_buf, (cfg["udp"]["send_host"], cfg["udp"]["send_port"]))
+    except Exception:
+        pass
+
+
+def _send_latest_controls() -> None:
+    while True:
+        _ctrl_ready.wait()
+        _ctrl_ready.clear()
+        _send_control(*_ctrl_latest)
+        # updates made meanwhile overwrite the slot and go out next tick
+        time.sleep(_MIN_CTRL_INTERVAL)
+
+
+def queue_control_packet(
     cfg: Dict[str, Any],
     zero: float,
     motor: float = 0.0,
     assist: float = 0.0,
     k_val: float = 0.0,
 ) -> None:
-    """Send a 4-float packet containing the four control signals."""
-    global _last_ctrl_ts
+    """Hand the control values to the background sender without blocking.
 
-    now = time.monotonic()
-    if now - _last_ctrl_ts < _MIN_CTRL_INTERVAL:
-        return
-    _last_ctrl_ts = now
-
-    payload = struct.pack(CONTROL_FMT, zero, motor, assist, k_val)
-    host = cfg["udp"]["send_host"]
-    port = cfg["udp"]["send_port"]
-    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
-        try:
-            sock.sendto(payload, (host, port))
-        except Exception:
-            pass
+    The sender transmits at most once per ``UPDATE_MS``; values set in
+    between replace each other, so the latest always goes out.
+    """
+    global _ctrl_thread, _ctrl_latest
+    if _ctrl_thread is None:
+        with _ctrl_thread_lock:
+            if _ctrl_thread is None:
+                _ctrl_thread = threading.Thread(target=_send_latest_controls, name="control-sender", daemon=True)
+                _ctrl_thread.start()
+    _ctrl_latest = (cfg, zero, motor, assist, k_val)
+    _ctrl_ready.set()
 
 
 def start_udp_listener(
     cfg: Dict[str, Any],
     stop_event: threading.Event | None = None,
 ) -> None:
-    """Listen to the UDP stream and push decoded packets to ``event_q``."""
+    """Listen to the UDP stream and publish decoded samples.
+
+    If no packet arrives within ``udp.fallback_after`` seconds of startup the
+    listener publishes fake samples so the dashboard can be exercised
+    offline, and switches to the real stream on its first valid datagram.
+    """
     if stop_event is None:
         stop_event = _stop_event
-    fmt = cfg["packet"]["format"]
-    expected = struct.calcsize(fmt)
+    _tune_listener_thread(cfg)
+    fallback_after = cfg["udp"].get("fallback_after", 2.0)
+    packet = struct.Struct(cfg["packet"]["format"])
+    unpack_from = packet.unpack_from
+    expected = packet.size
+    # one spare byte per slot so oversized datagrams show up as a length
+    # mismatch instead of being silently truncated to a valid-looking packet
+    slot = expected + 1
     mapping = cfg["signals"]
+    if "time" not in mapping and "Time" in mapping:
+        mapping = {**mapping, "time": mapping["Time"]}
+    # Resolve every sample field to its position in the unpacked tuple once,
+    # so the loop below never builds a dict or formats a key. Signals absent
+    # from the packet point one past the end, at a 0.0 appended per packet.
+    n_fields = len(unpack_from(bytes(expected)))
+    pad = (0.0,) if any(name not in mapping for name in _SAMPLE_SIGNALS) else ()
+
+    def index_of(name: str) -> int:
+        return mapping.get(name, n_fields)
+
+    t_idx = index_of("time")
+    ankle_idx = index_of("ankle_angle")
+    torque_idx = index_of("actual_torque")
+    demand_idx = index_of("demand_torque")
+    gait_idx = index_of("gait_percentage")
+    status_idx = index_of("statusword")
+    press_of = operator.itemgetter(*map(index_of, _PRESSURE_SIGNALS))
+    imu_of = operator.itemgetter(*map(index_of, _IMU_SIGNALS))
     host = cfg["udp"]["listen_host"]
     port = cfg["udp"]["listen_port"]
 
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    # Create the socket non-blocking in one call where the platform allows;
+    # Python already opens sockets close-on-exec (PEP 446).
+    nonblock = getattr(socket, "SOCK_NONBLOCK", 0)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM | nonblock)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     if hasattr(socket, "SO_REUSEPORT"):
         try:
             sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         except OSError:
             pass
+    rcvbuf = cfg["udp"].get("rcvbuf", 4 * 1024 * 1024)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    except OSError:
+        pass
+    # Linux silently caps the request at net.core.rmem_max and reports
+    # double the size it granted (the extra half is bookkeeping overhead)
+    granted = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+    if sys.platform.startswith("linux"):
+        granted //= 2
+    if granted < rcvbuf:
+        print(f"UDP receive buffer capped at {granted} bytes (requested {rcvbuf}); raise net.core.rmem_max")
+    track_drops = hasattr(socket, "recvmsg") and sys.platform.startswith("linux")
+    if track_drops:
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, _SO_RXQ_OVFL, 1)
+        except OSError:
+            track_drops = False
+    ancbufsize = socket.CMSG_SPACE(_DROP_COUNT.size) if track_drops else 0
+    reader: _DatagramReader | _BatchReader | None = None
+    if sys.platform.startswith("linux"):
+        try:
+            reader = _BatchReader(sock, slot, _DRAIN_MAX, ancbufsize)
+        except (AttributeError, OSError):
+            pass
+    if reader is None:
+        reader = _DatagramReader(sock, slot, ancbufsize)
+    buf = reader.buf
+    lengths = reader.lengths
+    reads_per_wakeup = max(1, _DRAIN_MAX // reader.count)
+    reported_drops = 0
+    last_drop_report = 0.0
     sock.bind((host, port))
-    sock.settimeout(1.0)
+    if not nonblock:
+        sock.setblocking(False)
 
     print(f"Listening for data on {host}:{port}")
+    started = time.monotonic()
+    received = False
 
     prev_t: float | None = None
     avg_dt: float = 0.0
-    count: int = 0
+    # fake samples stand in until the first valid datagram arrives
+    fake = None
+    fake_dt = 1.0 / SAMPLE_RATE_HZ
+    next_tick = 0.0
 
     while not stop_event.is_set():
-        try:
-            data, _ = sock.recvfrom(expected)
-        except socket.timeout:
-            continue
-        if len(data) != expected:
+        timeout = 0.5 if fake is None else max(0.0, next_tick - time.monotonic())
+        readable, _, _ = select.select((sock,), (), (), timeout)
+        if fake is not None:
+            now = time.monotonic()
+            if now >= next_tick:
+                publish(next(fake))
+                # pace against absolute deadlines; after a stall of over a
+                # second, resync rather than burst to catch up
+                next_tick += fake_dt
+                if now - next_tick > 1.0:
+                    next_tick = now
+        if not readable:
+            if fake is None and not received and time.monotonic() - started >= fallback_after:
+                print("No data from Simulink – using fake data generator")
+                fake = _fake_samples(fake_dt)
+                next_tick = time.monotonic()
             continue
 
-        decoded = decode_packet(data, fmt, mapping)
-        decoded["timestamp"] = time.time()
-        sim_t = decoded.get("time", decoded.get("Time", 0.0))
-        ankle = decoded.get("ankle_angle", 0.0)
-        torque = decoded.get("actual_torque", 0.0)
-        demand = decoded.get("demand_torque", 0.0)
-        gait = decoded.get("gait_percentage", 0.0)
+        # drain whatever queued up since the last wake-up in one go
+        for _ in range(reads_per_wakeup):
+            n = reader.read()
+            if not n:
+                break
+            for offset, nbytes in zip(range(0, n * slot, slot), lengths):
+                if nbytes != expected:
+                    continue
+                received = True
 
-        if prev_t is not None:
-            dt = sim_t - prev_t
-            avg_dt = (avg_dt * count + dt) / (count + 1)
-            count += 1
-        prev_t = sim_t
-
-        sample = {
-            "t": sim_t,
-            "ankle": ankle,
-            "torque": torque,
-            "demand_torque": demand,
-            "gait": gait,
-            "press": [decoded.get(f"pressure_{i}", 0.0) for i in range(1, 9)],
-            "imu": [decoded.get(f"imu_{i}", 0.0) for i in range(1, 13)],
-            "statusword": decoded.get("statusword", 0.0),
-            "avg_dt": avg_dt,
-        }
-        try:
-            event_q.put_nowait(sample)
-        except Full:
-            try:
-                event_q.get_nowait()
-            except Exception:
-                pass
-            try:
-                event_q.put_nowait(sample)
-            except Exception:
-                pass
-
-
-def start_fake_data(cfg: Dict[str, Any], stop_event: threading.Event | None = None) -> None:
-    """Generate synthetic samples when the Simulink host is unreachable."""
-    if stop_event is None:
-        stop_event = _stop_event
-    print("Simulink host unreachable – using fake data generator")
+                values = unpack_from(buf, offset)
+                if pad:
+                    values += pad
+                sim_t = values[t_idx]
+
+                if prev_t is not None:
+                    dt = sim_t - prev_t
+                    # EMA seeded with the first interval
+                    avg_dt = avg_dt + _DT_EMA_ALPHA * (dt - avg_dt) if avg_dt else dt
+                prev_t = sim_t
+
+                # field order is state.SAMPLE_FIELDS
+                publish((
+                    sim_t,
+                    values[ankle_idx],
+                    values[torque_idx],
+                    values[demand_idx],
+                    values[gait_idx],
+                    press_of(values),
+                    imu_of(values),
+                    values[status_idx],
+                    avg_dt,
+                ))
+
+        if fake is not None and received:
+            print("Receiving data from Simulink – stopping fake data generator")
+            fake = None
+
+        dropped = reader.dropped
+        if dropped != reported_drops:
+            now = time.monotonic()
+            if now - last_drop_report >= _DROP_REPORT_SEC:
+                print(f"Kernel dropped {dropped - reported_drops} UDP packets (total {dropped}); consider raising udp.rcvbuf")
+                reported_drops = dropped
+                last_drop_report = now
+
+
+def _fake_samples(dt: float) -> Iterator[tuple]:
+    """Yield synthetic samples *dt* seconds of simulated time apart."""
     t = 0.0
     prev_t: float | None = None
     avg_dt: float = 0.0
-    count: int = 0
-    dt = 1.0 / SAMPLE_RATE_HZ
-    while not stop_event.is_set():
+    while True:
         ankle = 20.0 * math.sin(t)
         torque = 5.0 * math.sin(t / 2.0)
         demand = 4.0 * math.sin(t / 2.0 + 0.5)
-        pressures = [500.0 + 100.0 * math.sin(t + i) for i in range(8)]
-        imus = [math.sin(t + i * 0.1) for i in range(12)]
+        pressures = tuple(500.0 + 100.0 * math.sin(t + i) for i in range(8))
+        imus = tuple(math.sin(t + i * 0.1) for i in range(12))
         gait = (t % 1.0) * 100.0
 
         if prev_t is not None:
             dt_sample = t - prev_t
-            avg_dt = (avg_dt * count + dt_sample) / (count + 1)
-            count += 1
+            avg_dt = avg_dt + _DT_EMA_ALPHA * (dt_sample - avg_dt) if avg_dt else dt_sample
         prev_t = t
 
-        sample = {
-            "t": t,
-            "ankle": ankle,
-            "torque": torque,
-            "demand_torque": demand,
-            "gait": gait,
-            "press": pressures,
-            "imu": imus,
-            "statusword": 1591,
-            "avg_dt": avg_dt,
-        }
-        try:
-            event_q.put_nowait(sample)
-        except Full:
-            try:
-                event_q.get_nowait()
-            except Exception:
-                pass
-            try:
-                event_q.put_nowait(sample)
-            except Exception:
-                pass
-
-        time.sleep(dt)
+        yield (t, ankle, torque, demand, gait, pressures, imus, 1591, avg_dt)
         t += dt
@@ -1,11 +1,105 @@
-from queue import Queue
+from collections import deque
+from queue import Empty
 import threading
+import time
+from typing import Any
 
-# Queue for server-sent events (SSE) to push fresh samples to the browser.
-# Only a single sample is stored; the browser keeps its own circular buffer.
-event_q: Queue = Queue(maxsize=1)
+from constants import SAMPLE_RATE_HZ
 
 # Limit concurrent SSE clients
 MAX_CLIENTS = 5
-_active_clients = 0
+
+# Field order of the plain tuples the data sources publish, one per packet.
+# ``press`` and ``imu`` are tuples of channel values.
+SAMPLE_FIELDS = (
+    "t",
+    "ankle",
+    "torque",
+    "demand_torque",
+    "gait",
+    "press",
+    "imu",
+    "statusword",
+    "avg_dt",
+)
 _client_lock = threading.Lock()
+
+
+class Subscriber:
+    """Bounded buffer between one producer and one consumer.
+
+    Keeps at most *maxlen* items and drops the oldest when full.
+    ``deque.append``/``popleft`` are atomic, so only the wake-up goes
+    through an ``Event``.
+    """
+
+    def __init__(self, maxlen: int = SAMPLE_RATE_HZ) -> None:
+        self.samples: deque = deque(maxlen=maxlen)
+        self.ready = threading.Event()
+
+    def put(self, sample: Any) -> None:
+        self.samples.append(sample)
+        self.ready.set()
+
+    def get(self, timeout: float) -> Any:
+        """Pop the oldest item, waiting up to *timeout* seconds.
+
+        Raises ``queue.Empty`` on timeout, like ``Queue.get``.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                return self.samples.popleft()
+            except IndexError:
+                pass
+            self.ready.clear()
+            # an item may have landed between popleft() and clear()
+            if self.samples:
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not self.ready.wait(remaining):
+                raise Empty
+
+
+# Samples from the UDP listener, drained by the single SSE broadcaster that
+# encodes each frame once for every client.
+_samples = Subscriber()
+
+# Encoded SSE frames, one buffer per connected client. The list is replaced
+# rather than mutated so the broadcaster can iterate it without the lock.
+_subscribers: list[Subscriber] = []
+
+
+def subscribe() -> Subscriber | None:
+    """Register an SSE client and return its frame buffer, or None when full."""
+    global _subscribers
+    with _client_lock:
+        if len(_subscribers) >= MAX_CLIENTS:
+            return None
+        sub = Subscriber()
+        _subscribers = _subscribers + [sub]
+        return sub
+
+
+def unsubscribe(sub: Subscriber) -> None:
+    """Remove a buffer previously returned by :func:`subscribe`."""
+    global _subscribers
+    with _client_lock:
+        _subscribers = [s for s in _subscribers if s is not sub]
+
+
+def publish(sample: tuple) -> None:
+    """Queue *sample* for the SSE broadcaster; dropped while nobody listens."""
+    if _subscribers:
+        _samples.put(sample)
+
+
+def next_sample(timeout: float) -> tuple:
+    """Pop the oldest published sample; raises ``queue.Empty`` on timeout."""
+    return _samples.get(timeout)
+
+
+def broadcast(frame: bytes) -> None:
+    """Hand an encoded SSE *frame* to every connected client."""
+    for sub in _subscribers:
+        sub.put(frame)